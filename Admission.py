@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""Admission control for expensive requests shared by all Apache children.
+
+Each child of a prefork Apache is its own process, so the limits are kept in
+lock files in a common directory rather than in memory:
+
+    slot-N   one per request allowed to compute at once
+    queue-N  one per request allowed to wait for a slot
+    clients  a shelve of the coordinate keys each client asked for recently
+    stats    counters for stats(), added to by every child
+
+A request holding an flock() on a slot file is computing; one holding a queue
+file is waiting. When every queue file is taken the request is turned away
+immediately instead of piling up behind the others. The holder of a file
+writes its pid in it, so that stats() can count them without locking."""
+
+__all__ = ['Admission']
+
+import errno
+import fcntl
+import os
+import shelve
+import time
+
+
+class Admission:
+
+    # How often a queued request looks for a free slot, seconds.
+    POLL = 0.05
+
+    # The shelve is swept once it holds more than MAX_CLIENTS clients:
+    # expired ones are dropped and, if that is not enough, the least recently
+    # seen until MAX_CLIENTS / 2 are left. Sweeping reads every client, so
+    # it happens at most once per MAX_CLIENTS / 2 new clients.
+    MAX_CLIENTS = 1000
+
+    # Counters kept in the stats file.
+    COUNTERS = ('admitted', 'rejected', 'limited', 'waits', 'waited',
+                'maxWait')
+
+    def __init__(self, directory, slots=2, queue=8, wait=10.0, keys=20,
+                 window=3600.0):
+        """
+        directory: where the lock files live; created if missing
+        slots:     requests computing at once, across all children
+        queue:     requests allowed to wait for a slot
+        wait:      seconds a queued request waits before giving up
+        keys:      distinct coordinate keys a client may ask for per window
+        window:    length of the rate limiting window, seconds
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.slots = slots
+        self.queue = queue
+        self.wait = wait
+        self.keys = keys
+        self.window = window
+
+    def limit(self, client, key):
+        """
+        Record that client asked for key. Returns 0 if that is allowed or,
+        if the client has already asked for the maximum number of other keys
+        in the window, the seconds until its oldest key leaves the window.
+        Asking again for a key it has asked for recently is always allowed.
+        """
+        lock = self.__open("clients.lock")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            db = shelve.open(os.path.join(self.directory, "clients"))
+            try:
+                now = time.time()
+                seen = self.__recent(db.get(client, {}), now)
+                if key not in seen and len(seen) >= self.keys:
+                    retry = int(min(seen.values()) + self.window - now) + 1
+                else:
+                    retry = 0
+                    seen[key] = now
+                    db[client] = seen
+                    if len(db) > self.MAX_CLIENTS:
+                        self.__sweep(db, now)
+            finally:
+                db.close()
+        finally:
+            lock.close()
+        if retry:
+            self.__add(limited=1)
+        return retry
+
+    def acquire(self):
+        """
+        Wait for a computation slot. Returns an object to pass to release(),
+        or None if the queue is full or no slot came free in time.
+        """
+        ticket = self.__tryLock("queue", self.queue)
+        if ticket is None:
+            self.__add(rejected=1)
+            return None
+        started = time.time()
+        try:
+            while True:
+                slot = self.__tryLock("slot", self.slots)
+                waited = time.time() - started
+                if slot is not None or waited >= self.wait:
+                    break
+                time.sleep(self.POLL)
+        finally:
+            self.__unlock(ticket)
+        if slot is None:
+            self.__add(rejected=1, waits=1, waited=waited, maxWait=waited)
+        else:
+            self.__add(admitted=1, waits=1, waited=waited, maxWait=waited)
+        return slot
+
+    def release(self, slot):
+        """Give back a slot returned by acquire()."""
+        self.__unlock(slot)
+
+    def retryAfter(self):
+        """Seconds a client turned away by acquire() should wait before
+        trying again."""
+        return int(self.wait) + 1
+
+    def stats(self):
+        """
+        Returns a dict of metrics across all children: busy and queued are
+        live counts, the rest totals since the stats file was created.
+        waits counts the requests that waited for a slot, whether or not
+        they got one, and meanWait and maxWait are over those.
+        """
+        stats = self.__add()
+        stats['meanWait'] = stats['waits'] and \
+            stats['waited'] / stats['waits'] or 0.0
+        stats.update({
+            'slots': self.slots,
+            'busy': self.__count("slot", self.slots),
+            'queue': self.queue,
+            'queued': self.__count("queue", self.queue),
+        })
+        return stats
+
+    def __add(self, **counts):
+        """Add counts to the counters in the stats file, maxWait being
+        raised rather than added to, and return the new values."""
+        f = os.fdopen(os.open(os.path.join(self.directory, "stats"),
+                              os.O_RDWR | os.O_CREAT, 0666), "r+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            stats = dict([(name, 0) for name in self.COUNTERS])
+            for line in f.read().splitlines():
+                name, value = line.split()
+                if name in ('waited', 'maxWait'):
+                    stats[name] = float(value)
+                else:
+                    stats[name] = int(value)
+            if counts:
+                for name, value in counts.items():
+                    if name == 'maxWait':
+                        stats[name] = max(stats[name], value)
+                    else:
+                        stats[name] += value
+                f.seek(0)
+                f.truncate()
+                f.write("".join(["%s %r\n" % (name, stats[name])
+                                 for name in self.COUNTERS]))
+            return stats
+        finally:
+            f.close()
+
+    def __sweep(self, db, now):
+        """Drop the expired clients from db and, if there are still more
+        than MAX_CLIENTS / 2, the least recently seen of the others."""
+        last = []
+        for client in db.keys():
+            seen = self.__recent(db[client], now)
+            if seen:
+                last.append((max(seen.values()), client))
+            else:
+                del db[client]
+        last.sort()
+        for t, client in last[:len(last) - self.MAX_CLIENTS / 2]:
+            del db[client]
+
+    def __recent(self, seen, now):
+        """Drop keys from a client's {key: time} dict that are out of the
+        window."""
+        return dict([(k, t) for k, t in seen.items()
+                     if now - t < self.window])
+
+    def __open(self, name):
+        return open(os.path.join(self.directory, name), "a")
+
+    def __tryLock(self, prefix, count):
+        """Returns the first of prefix-0..count-1 that could be locked, still
+        open and locked with our pid written in it, or None if all are held.
+        Pass it to __unlock() to unlock it."""
+        for i in range(count):
+            f = self.__open("%s-%d" % (prefix, i))
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                continue
+            f.truncate(0)
+            f.write(str(os.getpid()))
+            f.flush()
+            return f
+        return None
+
+    def __unlock(self, f):
+        f.truncate(0)
+        f.close()
+
+    def __count(self, prefix, count):
+        """Number of prefix-0..count-1 held by a live process, going by the
+        pids written in them. Taking a lock here instead, however briefly,
+        could make a real request find every file taken."""
+        held = 0
+        for i in range(count):
+            try:
+                f = open(os.path.join(self.directory, "%s-%d" % (prefix, i)))
+                try:
+                    pid = int(f.read() or 0)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                continue # Missing, or caught half written.
+            if pid:
+                try:
+                    os.kill(pid, 0)
+                except OSError, e:
+                    if e.errno != errno.EPERM:
+                        continue # Died holding it.
+                held += 1
+        return held
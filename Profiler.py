@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""On-demand profiling of requests in production.
+
+A request is profiled when it carries the secret key (e.g. &profile=<key>)
+or falls in a sampled fraction of traffic. Its cProfile stats are written
+to a directory that keeps only the newest files, and summary() adds them up
+to show where the time goes: Sun, vobject, gzip or elsewhere. When neither
+trigger is configured wanted() is a couple of attribute tests."""
+
+__all__ = ['Profiler']
+
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import time
+
+
+class Profiler:
+
+    # Where a function's time is counted in summary(), by the first pattern
+    # found in its file name or, for builtins, its name.
+    AREAS = [
+        ('Sun', ['Sun.py']),
+        ('vobject', ['vobject']),
+        ('gzip', ['gzip.py', 'zlib', 'compress']),
+    ]
+
+    def __init__(self, directory, rate=0.0, key=None, keep=50):
+        """
+        directory: where stats files go; created if missing
+        rate:      fraction of requests to profile, 0.0 for none
+        key:       secret that turns profiling on for one request, or None
+        keep:      how many of the newest stats files to keep
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.rate = rate
+        self.key = key
+        self.keep = keep
+
+    def authorized(self, flag):
+        """Does flag, sent by a client, match the key? Always False when
+        there is no key."""
+        return flag is not None and bool(self.key) and \
+            hmac.compare_digest(str(flag), self.key)
+
+    def wanted(self, flag=None):
+        """Should this request be profiled? flag is the value the client
+        sent for the key, if any."""
+        if flag is not None and self.authorized(flag):
+            return True
+        return self.rate > 0.0 and random.random() < self.rate
+
+    def call(self, name, func, *args):
+        """Return func(*args), saving its profile in a file named after
+        name."""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self.save(name, profile)
+
+    def save(self, name, profile):
+        path = os.path.join(self.directory, "%s-%d-%d.prof" % (
+            name, int(time.time() * 1000), os.getpid()))
+        profile.dump_stats(path)
+        files = self.files()
+        for old in files[:-self.keep]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass # Another child got there first.
+
+    def files(self):
+        """The saved stats files, oldest first."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".prof"):
+                path = os.path.join(self.directory, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        files.sort()
+        return [path for mtime, path in files]
+
+    def summary(self, count=20):
+        """
+        A plain text report over all saved profiles: the own time spent in
+        each area and the count functions with the most own time.
+        """
+        files = self.files()
+        if not files:
+            return "No profiles in %s\n" % self.directory
+        stats = pstats.Stats(files[0])
+        for path in files[1:]:
+            stats.add(path)
+        areas = {}
+        top = []
+        for (filename, line, func), (cc, nc, tt, ct, callers) in \
+                stats.stats.items():
+            area = self.__area(filename, func)
+            areas[area] = areas.get(area, 0.0) + tt
+            top.append((tt, nc, area, "%s:%d(%s)" % (filename, line, func)))
+        top.sort()
+        top.reverse()
+        total = sum(areas.values()) or 1.0
+        lines = ["%d profiles, %.3fs" % (len(files), total), ""]
+        names = areas.keys()
+        names.sort()
+        for area in names:
+            lines.append("%-8s %8.3fs %5.1f%%" % (
+                area, areas[area], 100 * areas[area] / total))
+        lines.append("")
+        for tt, nc, area, where in top[:count]:
+            lines.append("%8.3fs %8d  %-8s %s" % (tt, nc, area, where))
+        return "\n".join(lines) + "\n"
+
+    def __area(self, filename, func):
+        for area, patterns in self.AREAS:
+            for pattern in patterns:
+                if pattern in filename or pattern in func:
+                    return area
+        return 'other'
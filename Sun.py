@@ -32,10 +32,33 @@ SUN_PY_VERSION = 1.5
 
 import math
 import calendar
+import datetime
 
 
 class Sun:
 
+    # Day 0 of __daysSince2000Jan0 as a proleptic Gregorian ordinal.
+    DAY0_ORDINAL = datetime.date(1999, 12, 31).toordinal()
+
+    # Sampling interval, days, used to find the turning points of the day
+    # length. Near the equator it has two maxima and two minima a year.
+    SUMMARY_STEP = 8
+
+    # The macros grid() can evaluate: the workhorse function they wrap, the
+    # reference altitude, the upper limb flag and the offset aviationTime
+    # applies to the rise/set times.
+    GRID_MACROS = {
+        'dayLength': ('daylen', -35.0 / 60.0, 1, 0.0),
+        'dayCivilTwilightLength': ('daylen', -6.0, 0, 0.0),
+        'dayNauticalTwilightLength': ('daylen', -12.0, 0, 0.0),
+        'dayAstronomicalTwilightLength': ('daylen', -18.0, 0, 0.0),
+        'sunRiseSet': ('sunriset', -35.0 / 60.0, 1, 0.0),
+        'aviationTime': ('sunriset', -35.0 / 60.0, 1, 0.5),
+        'civilTwilight': ('sunriset', -6.0, 0, 0.0),
+        'nauticalTwilight': ('sunriset', -12.0, 0, 0.0),
+        'astronomicalTwilight': ('sunriset', -18.0, 0, 0.0),
+    }
+
     # Following are some macros around the "workhorse" function __daylen
     # They mainly fill in the desired values for the reference altitude
     # below the horizon, and also selects whether this altitude should
@@ -78,6 +101,57 @@ class Sun:
         """
         return cls.__daylen(year, month, day, lon, lat, -18.0, 0)
 
+    @classmethod
+    def dayLengthSummary(cls, year, lon, lat, thresholds=()):
+        """
+        This macro summarizes the length of the day over a year: the longest
+        and shortest days, runs of polar days and nights, and the days on
+        which it crosses each of the given thresholds (hours).
+        """
+        return cls.__daylenSummary(year, lon, lat, -35.0 / 60.0, 1,
+                                   thresholds)
+
+    @classmethod
+    def dayCivilTwilightLengthSummary(cls, year, lon, lat, thresholds=()):
+        """
+        This macro summarizes the length of the day, including civil
+        twilight, over a year.
+        """
+        return cls.__daylenSummary(year, lon, lat, -6.0, 0, thresholds)
+
+    @classmethod
+    def dayNauticalTwilightLengthSummary(cls, year, lon, lat, thresholds=()):
+        """
+        This macro summarizes the length of the day, incl. nautical twilight,
+        over a year.
+        """
+        return cls.__daylenSummary(year, lon, lat, -12.0, 0, thresholds)
+
+    @classmethod
+    def dayAstronomicalTwilightLengthSummary(cls, year, lon, lat,
+                                             thresholds=()):
+        """
+        This macro summarizes the length of the day, incl. astronomical
+        twilight, over a year.
+        """
+        return cls.__daylenSummary(year, lon, lat, -18.0, 0, thresholds)
+
+    @classmethod
+    def grid(cls, name, year, month, day, lons, lats):
+        """
+        Evaluates the macro called name (one of GRID_MACROS) on one date at
+        every combination of lats and lons, returning one row per latitude
+        with the same values as calling the macro at each point. The Sun's
+        position depends only on the longitude and is computed once per
+        column rather than once per point.
+        """
+        kind, altit, upper_limb, offset = cls.GRID_MACROS[name]
+        if kind == 'daylen':
+            return cls.__daylenGrid(year, month, day, lons, lats, altit,
+                                    upper_limb)
+        return cls.__sunrisetGrid(year, month, day, lons, lats, altit,
+                                  upper_limb, offset)
+
     @classmethod
     def sunRiseSet(cls, year, month, day, lon, lat):
         """
@@ -213,6 +287,18 @@ class Sun:
         # Compute d of 12h local mean solar time
         d = cls.__daysSince2000Jan0(year, month, day) + 0.5 - lon / 360.0
 
+        return cls.__arcHours(cls.__diurnalCos(d, lat, altit, upper_limb))
+
+    @classmethod
+    def __diurnalCos(cls, d, lat, altit, upper_limb):
+        """
+        Computes the cosine of half the diurnal arc the Sun traverses above
+        altit at an instant given in d, number of days since 2000 Jan 0.0.
+        It is not clamped: >= 1.0 means the Sun stays below altit all day
+        and <= -1.0 that it stays above it, so unlike the day length it is
+        a smooth function of d.
+        """
+
         # Compute obliquity of ecliptic (inclination of Earth's axis)
         obl_ecl = 23.4393 - 3.563E-7 * d
 
@@ -230,8 +316,12 @@ class Sun:
         if upper_limb:
             altit = altit - sradius
 
-        cost = (cls.__sind(altit) - cls.__sind(lat) * sin_sdecl) / \
+        return (cls.__sind(altit) - cls.__sind(lat) * sin_sdecl) / \
                (cls.__cosd(lat) * cos_sdecl)
+
+    @classmethod
+    def __arcHours(cls, cost):
+        """Day length in hours for the cosine returned by __diurnalCos."""
         if cost >= 1.0:
             return 0.0             # Sun always below altit
 
@@ -241,6 +331,193 @@ class Sun:
         else:
             return 2.0 / 15.0 * cls.__acosd(cost)     # The diurnal arc, hours
 
+    @classmethod
+    def __sunrisetGrid(cls, year, month, day, lons, lats, altit, upper_limb,
+                       offset):
+        """
+        __sunriset for every lat/lon pair, as rows of (rise - offset,
+        set + offset) tuples. Mirrors __sunriset step by step, with the
+        per-longitude and per-latitude terms hoisted out of the inner loop.
+        """
+        days = cls.__daysSince2000Jan0(year, month, day)
+        columns = []
+        for lon in lons:
+            d = days + 0.5 - (lon / 360.0)
+            sidtime = cls.__revolution(cls.__GMST0(d) + 180.0 + lon)
+            sRA, sdec, sr = cls.__sunRADec(d)
+            tsouth = 12.0 - cls.__rev180(sidtime - sRA) / 15.0
+            a = altit
+            if upper_limb:
+                a = a - 0.2666 / sr
+            columns.append((tsouth, cls.__sind(a), cls.__sind(sdec),
+                            cls.__cosd(sdec)))
+        rows = []
+        for lat in lats:
+            sinlat = cls.__sind(lat)
+            coslat = cls.__cosd(lat)
+            row = []
+            for tsouth, sinalt, sindec, cosdec in columns:
+                cost = (sinalt - sinlat * sindec) / (coslat * cosdec)
+                if cost >= 1.0:
+                    t = 0.0
+                elif cost <= -1.0:
+                    t = 12.0
+                else:
+                    t = cls.__acosd(cost) / 15.0
+                row.append((tsouth - t - offset, tsouth + t + offset))
+            rows.append(row)
+        return rows
+
+    @classmethod
+    def __daylenGrid(cls, year, month, day, lons, lats, altit, upper_limb):
+        """
+        __daylen for every lat/lon pair, as rows of hours. Mirrors
+        __diurnalCos with the per-longitude and per-latitude terms hoisted
+        out of the inner loop.
+        """
+        days = cls.__daysSince2000Jan0(year, month, day)
+        columns = []
+        for lon in lons:
+            d = days + 0.5 - lon / 360.0
+            obl_ecl = 23.4393 - 3.563E-7 * d
+            slon, sr = cls.__sunpos(d)
+            sin_sdecl = cls.__sind(obl_ecl) * cls.__sind(slon)
+            cos_sdecl = math.sqrt(1.0 - sin_sdecl * sin_sdecl)
+            a = altit
+            if upper_limb:
+                a = a - 0.2666 / sr
+            columns.append((cls.__sind(a), sin_sdecl, cos_sdecl))
+        rows = []
+        arcHours = cls.__arcHours
+        for lat in lats:
+            sinlat = cls.__sind(lat)
+            coslat = cls.__cosd(lat)
+            rows.append([arcHours((sinalt - sinlat * sindec) /
+                                  (coslat * cosdec))
+                         for sinalt, sindec, cosdec in columns])
+        return rows
+
+    @classmethod
+    def __daylenSummary(cls, year, lon, lat, altit, upper_limb, thresholds):
+        """
+        Summarizes __daylen over the days of a year without computing it for
+        every day. The cosine from __diurnalCos is sampled every
+        SUMMARY_STEP days and each local extremum is narrowed down to a day
+        by ternary search. Between those turning days the day length is
+        monotonic, so each event below is found by bisection.
+
+        Returns a dict with
+            longest, shortest: (date, hours). On polar days or nights the
+                      extreme lasts many days; the date is then the turning
+                      day or the edge of the year.
+            polarDays, polarNights: lists of (first date, last date) runs
+                      of days with 24.0 and 0.0 hours.
+            crossings: {threshold: [(date, rising), ...]}, the days on which
+                      the day length becomes >= threshold (rising true) or
+                      drops below it again, compared with the day before.
+        """
+        first = cls.__daysSince2000Jan0(year, 1, 1)
+        last = cls.__daysSince2000Jan0(year, 12, 31)
+        costs = {}
+
+        def cost(day):
+            try:
+                return costs[day]
+            except KeyError:
+                c = costs[day] = cls.__diurnalCos(day + 0.5 - lon / 360.0,
+                                                  lat, altit, upper_limb)
+                return c
+
+        def length(day):
+            return cls.__arcHours(cost(day))
+
+        def toDate(day):
+            return datetime.date.fromordinal(cls.DAY0_ORDINAL + day)
+
+        bounds = [first] + cls.__turningDays(cost, first, last,
+                                             cls.SUMMARY_STEP) + [last]
+
+        def transitions(pred):
+            days = []
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                before = pred(a)
+                if pred(b) != before:
+                    # pred(lo) == before, pred(hi) != before
+                    lo, hi = a, b
+                    while hi - lo > 1:
+                        mid = (lo + hi) / 2
+                        if pred(mid) == before:
+                            lo = mid
+                        else:
+                            hi = mid
+                    days.append(hi)
+            return days
+
+        def runs(pred):
+            found = []
+            inside = pred(first)
+            start = first
+            for day in transitions(pred):
+                if inside:
+                    found.append((toDate(start), toDate(day - 1)))
+                else:
+                    start = day
+                inside = not inside
+            if inside:
+                found.append((toDate(start), toDate(last)))
+            return found
+
+        longest = shortest = first
+        for day in bounds:
+            if length(day) > length(longest):
+                longest = day
+            if length(day) < length(shortest):
+                shortest = day
+
+        crossings = {}
+        for threshold in thresholds:
+            crossings[threshold] = [
+                (toDate(day), length(day) >= threshold) for day in
+                transitions(lambda day: length(day) >= threshold)]
+
+        return {
+            'longest': (toDate(longest), length(longest)),
+            'shortest': (toDate(shortest), length(shortest)),
+            'polarDays': runs(lambda day: cost(day) <= -1.0),
+            'polarNights': runs(lambda day: cost(day) >= 1.0),
+            'crossings': crossings,
+        }
+
+    @staticmethod
+    def __turningDays(f, first, last, step):
+        """
+        Returns the days in first..last, in order, at which f has a local
+        extremum. f is sampled every step days, which must be less than
+        half the distance between neighbouring extrema.
+        """
+        samples = range(first, last, step) + [last]
+        values = [f(day) for day in samples]
+        turns = []
+        for i in range(1, len(samples) - 1):
+            if (values[i] - values[i - 1]) * (values[i + 1] - values[i]) > 0:
+                continue
+            # Maximize sign * f over the bracket around sample i.
+            sign = values[i] > values[i - 1] and 1 or -1
+            lo, hi = samples[i - 1], samples[i + 1]
+            while hi - lo > 2:
+                m1 = lo + (hi - lo) / 3
+                m2 = hi - (hi - lo) / 3
+                if sign * f(m1) < sign * f(m2):
+                    lo = m1 + 1
+                else:
+                    hi = m2 - 1
+            best = lo
+            for day in range(lo + 1, hi + 1):
+                if sign * f(day) > sign * f(best):
+                    best = day
+            turns.append(best)
+        return turns
+
     @classmethod
     def __sunpos(cls, d):
         """
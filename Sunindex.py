@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""Sun times for one location over a range of days, indexed so that range
+questions like "on which days is sunset after 20:00 UTC?" are answered
+without scanning every day.
+
+Each series of times is split into runs over which it only rises or only
+falls. Within a run the days matching a range of times are contiguous and
+are found by binary search, so a query costs a couple of bisections per run
+(a handful a year) rather than one comparison per day."""
+
+__all__ = ['Sunindex']
+
+import bisect
+from datetime import date as Date
+
+from Sun import Sun
+
+
+class Sunindex:
+
+    EVENTS = ('rise', 'set')
+
+    def __init__(self, lat, lon, date, days, cal="sunRiseSet"):
+        """Compute the times of Sun.<cal> at lat/lon for days days from
+        date."""
+        self.check(cal)
+        f = getattr(Sun, cal)
+        offset = Sun.GRID_MACROS[cal][3]
+        self.first = date.toordinal()
+        self.days = days
+        series = ([], [])
+        for day in range(self.first, self.first + days):
+            d = Date.fromordinal(day)
+            times = f(d.year, d.month, d.day, lon, lat) # lat/long reversed.
+            arc = times[1] - times[0] - 2 * offset
+            if abs(arc) < 1e-9 or abs(arc - 24.0) < 1e-9:
+                # A polar day or night: the Sun neither rises nor sets and
+                # the times are only placeholders. Such days never match.
+                for i in range(2):
+                    series[i].append(None)
+                continue
+            for i in range(2):
+                # Time of day, UT. Sun may return hours outside 0..24.
+                series[i].append(times[i] % 24)
+        self.series = series
+        self.segments = [self.__segments(values) for values in series]
+
+    @classmethod
+    def check(cls, cal, event='rise'):
+        """Raise ValueError unless cal is one of the rise/set macros of Sun
+        (see Sun.GRID_MACROS) and event is one of EVENTS."""
+        if Sun.GRID_MACROS.get(cal, (None,))[0] != 'sunriset' or \
+                event not in cls.EVENTS:
+            raise ValueError("no such times %s %s" % (cal, event))
+
+    def query(self, event, after=None, before=None):
+        """
+        Returns the days on which the time of day, UT, of event ('rise' or
+        'set') is >= after and < before, both in hours, as a list of (first
+        date, last date) runs. Either bound may be None. If after > before
+        the range wraps around midnight. Polar days and nights, on which
+        there is no event, are never included.
+        """
+        i = list(self.EVENTS).index(event)
+        if after is None:
+            after = 0.0
+        if before is None:
+            before = 24.0
+        if after > before:
+            spans = self.__spans(i, after, 24.0) + self.__spans(i, 0.0, before)
+            spans.sort()
+        else:
+            spans = self.__spans(i, after, before)
+        runs = []
+        for start, end in spans:
+            if runs and runs[-1][1] == start:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end])
+        return [(Date.fromordinal(self.first + start),
+                 Date.fromordinal(self.first + end - 1))
+                for start, end in runs]
+
+    def __spans(self, i, low, high):
+        """Half-open index ranges of days with low <= series[i] < high."""
+        spans = []
+        for start, keys, sign in self.segments[i]:
+            if sign > 0:
+                a = bisect.bisect_left(keys, low)
+                b = bisect.bisect_left(keys, high)
+            else:
+                a = bisect.bisect_right(keys, -high)
+                b = bisect.bisect_right(keys, -low)
+            if a < b:
+                spans.append((start + a, start + b))
+        return spans
+
+    @staticmethod
+    def __segments(values):
+        """
+        Split values into maximal runs that never fall or never rise,
+        leaving out Nones. Returns a list of (start, keys, sign) where keys
+        is the run multiplied by sign, so that it is always ascending.
+        """
+        segments = []
+        start = 0
+        while start < len(values):
+            if values[start] is None:
+                start += 1
+                continue
+            end = start + 1
+            sign = 1
+            if end < len(values) and values[end] is not None and \
+                    values[end] < values[start]:
+                sign = -1
+            while end < len(values) and values[end] is not None and \
+                    sign * values[end] >= sign * values[end - 1]:
+                end += 1
+            segments.append((start, [sign * v for v in values[start:end]],
+                             sign))
+            start = end
+        return segments
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""Map tiles of day length or sunrise/sunset times on one date.
+
+Tiles use the usual web map z/x/y numbering on the spherical Mercator
+projection, so they line up with OpenStreetMap style base layers. Each pixel
+holds the value at its centre, computed with Sun.grid."""
+
+__all__ = ['Suntile']
+
+import math
+import struct
+import sys
+import zlib
+from array import array
+
+from Sun import Sun
+
+NAN = float('nan')
+
+
+class Suntile:
+
+    SIZE = 256
+
+    # Deepest zoom level accepted; beyond this pixels are centimetres apart.
+    MAX_ZOOM = 22
+
+    def __init__(self, z, x, y, date, name="dayLength", event="rise"):
+        """
+        Compute tile z/x/y of the Sun macro name (see Sun.GRID_MACROS) on
+        date. For the rise/set macros event picks "rise" or "set" and the
+        values are the time of day, UT, in hours, or NaN on polar days and
+        nights, when there is no such event; otherwise they are hours of
+        daylight.
+        """
+        self.check(z, x, y, name, event)
+        scale = float(self.SIZE * 2 ** z)
+        lons = [(x * self.SIZE + i + 0.5) / scale * 360.0 - 180.0
+                for i in range(self.SIZE)]
+        lats = [math.degrees(math.atan(math.sinh(
+                    math.pi * (1.0 - 2.0 * (y * self.SIZE + j + 0.5) / scale))))
+                for j in range(self.SIZE)]
+        rows = Sun.grid(name, date.year, date.month, date.day, lons, lats)
+        kind, altit, upper_limb, offset = Sun.GRID_MACROS[name]
+        self.times = kind == 'sunriset'
+        if self.times:
+            i = event == 'set' and 1 or 0
+            rows = [[self.__time(times, i, offset) for times in row]
+                    for row in rows]
+        self.rows = rows
+
+    @classmethod
+    def check(cls, z, x, y, name, event):
+        """Raise ValueError unless the arguments describe a tile."""
+        if not 0 <= z <= cls.MAX_ZOOM or not 0 <= x < 2 ** z or \
+                not 0 <= y < 2 ** z:
+            raise ValueError("no tile %d/%d/%d" % (z, x, y))
+        if name not in Sun.GRID_MACROS or event not in ('rise', 'set'):
+            raise ValueError("no such value %s %s" % (name, event))
+
+    def float32(self):
+        """The values as little-endian float32, row by row from the north,
+        NaN where there is no time."""
+        values = array('f')
+        for row in self.rows:
+            values.extend(row)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values.tostring()
+
+    def png(self):
+        """
+        The values as an 8-bit greyscale PNG, black 0h to white 24h. For
+        times of day 24h is 0h, black, and white is kept for the pixels
+        without a time, which are made transparent.
+        """
+        raw = []
+        for row in self.rows:
+            raw.append("\0")
+            if self.times:
+                # v != v is true only of NaN.
+                levels = [v != v and 255 or int(v * (255 / 24.0) + 0.5) % 255
+                          for v in row]
+            else:
+                levels = [int(v * (255 / 24.0) + 0.5) for v in row]
+            raw.append(array('B', levels).tostring())
+        chunks = [
+            "\x89PNG\r\n\x1a\n",
+            self.__chunk("IHDR", struct.pack("!2I5B", self.SIZE, self.SIZE,
+                                             8, 0, 0, 0, 0)),
+        ]
+        if self.times:
+            chunks.append(self.__chunk("tRNS", struct.pack("!H", 255)))
+        chunks.extend([
+            self.__chunk("IDAT", zlib.compress("".join(raw))),
+            self.__chunk("IEND", ""),
+        ])
+        return "".join(chunks)
+
+    @staticmethod
+    def __time(times, i, offset):
+        """Time of day of times[i] from a rise/set macro, or NaN on polar
+        days and nights, where the macro returns placeholders 0h or 24h
+        apart (plus the macro's offset either side)."""
+        arc = times[1] - times[0] - 2 * offset
+        if abs(arc) < 1e-9 or abs(arc - 24.0) < 1e-9:
+            return NAN
+        return times[i] % 24
+
+    @staticmethod
+    def __chunk(tag, data):
+        return struct.pack("!I", len(data)) + tag + data + \
+            struct.pack("!I", zlib.crc32(tag + data) & 0xffffffff)
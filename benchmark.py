@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+# -*- coding: iso-8859-1 -*-
+
+"""Rough timings for the calendar generator. Run as
+
+    python benchmark.py
+
+Each benchmark prints the best of a few runs so that numbers from different
+versions of the code can be compared by eye."""
+
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+import calendar
+
+LAT, LON = 55.932756, -3.177664
+START = datetime(2024, 1, 1, 10, 0, 0)
+DAYS = 365
+
+
+def _best(func, number=1, repeat=5):
+    """Return the best time in seconds of a single call to func."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def _report(name, seconds, count=None, unit="event"):
+    if count:
+        print "%-40s %9.3f ms  %8.2f us/%s" % (name, seconds * 1e3,
+                                               seconds * 1e6 / count, unit)
+    else:
+        print "%-40s %9.3f ms" % (name, seconds * 1e3)
+
+
+def _legacyTimes(date, times):
+    """The per-event conversion Suncal used to do: build a tz-aware datetime
+    from truncated hours/minutes/seconds and timegm it for the UID."""
+    import vobject
+    utc = vobject.icalendar.utc
+    stamps = []
+    for day, hours in times:
+        d = date + timedelta(days=day)
+        minute = 60 * (hours - int(hours))
+        second = 60 * (minute - int(minute))
+        value = datetime(d.year, d.month, d.day, int(hours), int(minute),
+                         int(second), tzinfo=utc)
+        stamps.append((calendar.timegm(value.timetuple()), value))
+    return stamps
+
+
+def _benchEvents():
+    """Timestamp conversion for one year of rise/set events."""
+    from Sun import Sun
+    from index import _icsTimes
+    times = []
+    d = START
+    for day in range(DAYS):
+        rise, set = Sun.sunRiseSet(d.year, d.month, d.day, LON, LAT)
+        times.append((day, rise))
+        times.append((day, set))
+        d += timedelta(days=1)
+    _report("timestamps: datetime + timegm",
+            _best(lambda: _legacyTimes(START, times)), len(times))
+    _report("timestamps: _icsTimes",
+            _best(lambda: _icsTimes(START, times)), len(times))
+
+
+def _benchSuncal():
+    """Whole-calendar construction and serialization."""
+    from index import Suncal
+    for cal in ("sunRiseSet", "dayNightTime"):
+        _report("Suncal(%s)" % cal,
+                _best(lambda: Suncal(LAT, LON, START, DAYS, cal), repeat=3),
+                2 * DAYS)
+        k = Suncal(LAT, LON, START, DAYS, cal)
+        _report("Suncal(%s).ical()" % cal, _best(k.ical, repeat=3), 2 * DAYS)
+
+
+def _scanDayLength(year, lon, lat):
+    """Longest and shortest day of a year by calling Sun.dayLength for every
+    day, the way callers had to before Sun.dayLengthSummary."""
+    from Sun import Sun
+    d = datetime(year, 1, 1)
+    longest = shortest = None
+    while d.year == year:
+        hours = Sun.dayLength(d.year, d.month, d.day, lon, lat)
+        if longest is None or hours > longest[1]:
+            longest = (d.date(), hours)
+        if shortest is None or hours < shortest[1]:
+            shortest = (d.date(), hours)
+        d += timedelta(days=1)
+    return longest, shortest
+
+
+def _benchDayLength():
+    """Annual longest/shortest day for a grid of locations."""
+    from Sun import Sun
+    locations = [(lon, lat) for lat in range(-85, 90, 10)
+                 for lon in range(-180, 180, 60)]
+    _report("daily scan", _best(lambda: [_scanDayLength(2024, lon, lat)
+                                         for lon, lat in locations], repeat=3),
+            len(locations), "location")
+    _report("dayLengthSummary",
+            _best(lambda: [Sun.dayLengthSummary(2024, lon, lat)
+                           for lon, lat in locations], repeat=3),
+            len(locations), "location")
+    differ = 0
+    for lon, lat in locations:
+        summary = Sun.dayLengthSummary(2024, lon, lat)
+        longest, shortest = _scanDayLength(2024, lon, lat)
+        if (summary['longest'][1], summary['shortest'][1]) != \
+                (longest[1], shortest[1]):
+            differ += 1
+    print "dayLengthSummary disagrees with scan at %d of %d locations" % (
+        differ, len(locations))
+
+
+def _benchQuery():
+    """Building a Sunindex and querying it over multi-year ranges."""
+    from Sunindex import Sunindex
+    for years in (2, 10):
+        days = 365 * years
+        _report("Sunindex build, %d years" % years,
+                _best(lambda: Sunindex(LAT, LON, START.date(), days),
+                      repeat=3), days, "day")
+        k = Sunindex(LAT, LON, START.date(), days)
+        sets = k.series[1]
+        _report("scan for sunset >= 20:00, %d years" % years,
+                _best(lambda: [i for i in range(days) if sets[i] >= 20.0],
+                      number=10), days, "day")
+        _report("Sunindex.query sunset >= 20:00, %d years" % years,
+                _best(lambda: k.query('set', 20.0), number=100), days, "day")
+
+
+def _benchTiles():
+    """Tiles per second, rendered from scratch and from the tile cache."""
+    from Sun import Sun
+    from Suntile import Suntile
+    import index
+    d = START.date()
+    for name in ("dayLength", "sunRiseSet"):
+        seconds = _best(lambda: Suntile(3, 4, 2, d, name), repeat=3)
+        _report("Suntile(%s), %.1f tiles/s" % (name, 1 / seconds), seconds,
+                Suntile.SIZE ** 2, "pixel")
+    k = Suntile(3, 4, 2, d)
+    _report("Suntile.png()", _best(k.png, repeat=3))
+    _report("Suntile.float32()", _best(k.float32, repeat=3))
+    lons = [LON + i * 0.01 for i in range(Suntile.SIZE)]
+    seconds = _best(lambda: [Sun.dayLength(d.year, d.month, d.day, lon, lat)
+                             for lat in lons for lon in lons], repeat=1)
+    _report("Sun.dayLength per pixel, %.1f tiles/s" % (1 / seconds), seconds,
+            Suntile.SIZE ** 2, "pixel")
+    options = {'SuncalQueueDir': tempfile.mkdtemp()}
+    index.tile(_FakeRequest(options=options), 3, 4, 2, str(d))
+    seconds = _best(lambda: index.tile(_FakeRequest(options=options),
+                                       3, 4, 2, str(d)), number=100)
+    _report("cached tile route, %.0f tiles/s" % (1 / seconds), seconds)
+
+
+class _FakeConnection:
+
+    def __init__(self, remote_ip):
+        self.remote_ip = remote_ip
+
+
+class _FakeRequest:
+    """Just enough of a mod_python request for the routes in index.py."""
+
+    def __init__(self, gzip=True, remote_ip="127.0.0.1", options=None):
+        self.headers_in = {}
+        if gzip:
+            self.headers_in['accept-encoding'] = "gzip, deflate"
+        self.headers_out = {}
+        self.connection = _FakeConnection(remote_ip)
+        self.options = options or {}
+        self.status = 200
+        self.body = []
+
+    def get_options(self):
+        return self.options
+
+    def send_http_header(self):
+        pass
+
+    def write(self, s):
+        self.body.append(s)
+
+
+# Run in a fresh interpreter, standing in for a newly forked worker. Prints
+# the milliseconds taken by each step.
+STARTUP_SCRIPT = """
+import sys, tempfile, time
+from benchmark import _FakeRequest, LAT, LON
+options = {'SuncalQueueDir': tempfile.mkdtemp(),
+           'SuncalProfileDir': tempfile.mkdtemp()}
+t = time.time()
+def step(name):
+    global t
+    now = time.time()
+    print name, (now - t) * 1e3
+    t = now
+import index
+step("import")
+if sys.argv[1] == "preload":
+    index._preload()
+    step("preload")
+index.index(_FakeRequest(options=options))
+step("index")
+index._loadVobject()
+import Admission, Profiler, Sunindex, Suntile
+step("imports")
+index.cal(_FakeRequest(options=options), LAT, LON)
+step("cal")
+index.cal(_FakeRequest(options=options), LAT, LON)
+step("cal2")
+"""
+
+# First-request latency target after a worker fork, in milliseconds: with
+# _preload() done, the first index must be served from cache and the
+# imports the first cal or tile would do must already be done. Without
+# _preload() they take tens of milliseconds, so a preload that stops
+# working misses the target.
+STARTUP_TARGET = 1.0
+# Fresh interpreters started per mode; each step counts its best run.
+STARTUP_RUNS = 7
+
+
+def _benchStartup():
+    """Import cost and first-request latency of a fresh worker."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    for mode in ("cold", "preload"):
+        runs = []
+        for i in range(STARTUP_RUNS):
+            out = subprocess.Popen(
+                [sys.executable, "-c", STARTUP_SCRIPT, mode], cwd=here,
+                stdout=subprocess.PIPE)
+            runs.append(dict((name, float(ms)) for name, ms in
+                             [line.split() for line in out.communicate()[0]
+                              .splitlines()]))
+        steps = dict((name, min(run[name] for run in runs))
+                     for name in runs[0])
+        for name in ("import", "preload", "index", "imports", "cal", "cal2"):
+            if name in steps:
+                _report("startup %s: %s" % (mode, name), steps[name] / 1e3)
+        if mode == "preload":
+            ok = (steps["index"] <= STARTUP_TARGET and
+                  steps["imports"] <= STARTUP_TARGET)
+            print "startup target %s" % (ok and "met" or "MISSED")
+
+
+BENCHMARKS = [
+    ("events", _benchEvents),
+    ("suncal", _benchSuncal),
+    ("startup", _benchStartup),
+    ("daylen", _benchDayLength),
+    ("query", _benchQuery),
+    ("tiles", _benchTiles),
+]
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    for name, func in BENCHMARKS:
+        if not names or name in names:
+            func()
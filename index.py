@@ -9,12 +9,49 @@ Note: The Sun.py library used seems to follow the long/lat convention, which is
 different from the more-commonly used lat/long convention. We attempt to use
 lat/long where possible."""
 
-import vobject
 from datetime import datetime, timedelta
 import calendar
-import gzip
-import cStringIO
+from collections import OrderedDict
+import math
+import os
+import time
 from mod_python import apache
+from Sun import Sun
+# Admission, Profiler, Sunindex and Suntile, and the modules they pull in,
+# are imported by the routes that need them to keep worker startup cheap.
+
+# Imported on first use by _loadVobject(); only the cal route needs it.
+vobject = None
+
+# Files served verbatim by the routes of the same name. Like the other
+# module constants it is underscore-prefixed: the publisher would serve it.
+_STATIC_FILES = {
+    'Sunsource': "/var/www/markc/markc.dev.obanmultilingual.com/web/suncal/Sun.py",
+    'source': "/var/www/markc/markc.dev.obanmultilingual.com/web/suncal/index.py",
+}
+
+# Static response bodies, (plain, gzipped), filled in by _cachedBody().
+_bodies = {}
+
+# Limits on calendar computation, created by _getAdmission().
+_admission = None
+
+# Profiling of cal requests, created by _getProfiler().
+_profiler = None
+
+# Recently queried Sunindexes, least recently used first.
+_indexes = OrderedDict()
+_INDEX_CACHE_SIZE = 64
+
+# Longest range of days the query route will index.
+_QUERY_MAX_DAYS = 3660
+
+# Recently rendered tiles, least recently used first, each kept in one form
+# only: PNGs as they are, float32 tiles gzipped. _tileBytes is their total
+# size, kept under _TILE_CACHE_BYTES.
+_tiles = OrderedDict()
+_tileBytes = 0
+_TILE_CACHE_BYTES = 8 * 1024 * 1024
 
 
 class Suncal:
@@ -22,14 +59,12 @@ class Suncal:
        string representation of the ICS."""
 
     def __init__(self, lat, lon, date, days, cal="sunRiseSet"):
-        from Sun import Sun
+        _loadVobject()
         f = getattr(Sun, cal, Sun.sunRiseSet)
-        self.utc = vobject.icalendar.utc
         self.v = vobject.iCalendar()
         self.lat = lat
         self.lon = lon
         self.d = date
-        self.d2 = date + timedelta(days=1);
         if cal == "sunRiseSet":
             name = "Sunrise and Sunset times for %fN, %fW"
             start = "Sunrise"
@@ -63,43 +98,88 @@ class Suncal:
             "-//Bruce Duncan//Sunriseset Calendar 1.2//EN"
         self.v.add('description').value = "Show the sunrise and sunset times" \
             + " for a given location for one year from the current date."
-        for date in range(days):
-            riseTime, setTime = f(self.d.year, self.d.month, self.d.day, lon, lat) # lat/long reversed.
-            riseTime2, setTime2 = f(self.d2.year, self.d2.month, self.d2.day, lon, lat) # lat/long reversed.
+        day = self.d
+        results = []
+        for i in range(days + (cal == "dayNightTime")):
+            results.append(f(day.year, day.month, day.day, lon, lat)) # lat/long reversed.
+            day += timedelta(days=1)
+        points = []
+        for i in range(days):
+            riseTime, setTime = results[i]
             if cal == "dayNightTime":
-                self.__addPoint(riseTime, (setTime - (1.0 / 3600)) % 24, self.d, self.d, start)
-                self.__addPoint(setTime, (riseTime2 - (1.0 / 3600)) % 24, self.d, self.d2, end)
+                riseTime2 = results[i + 1][0]
+                # Raw hours; _icsTimes rolls them over into the right day.
+                points.append((i, riseTime, i, setTime - (1.0 / 3600), start))
+                points.append((i, setTime, i + 1, riseTime2 - (1.0 / 3600), end))
             else:
-                riseTime, setTime = f(self.d.year, self.d.month, self.d.day, lon, lat) # lat/long reversed.
-                self.__addPoint(riseTime, riseTime, self.d, self.d, start)
-                self.__addPoint(setTime, setTime, self.d, self.d, end)
-            self.d += timedelta(days=1)
-            self.d2 += timedelta(days=1)
+                points.append((i, riseTime, i, riseTime, start))
+                points.append((i, setTime, i, setTime, end))
+        times = []
+        for point in points:
+            times.append((point[0], point[1]))
+            times.append((point[2], point[3]))
+        stamps = _icsTimes(self.d, times)
+        dtstamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        for i, point in enumerate(points):
+            self.__addPoint(stamps[2 * i], stamps[2 * i + 1], dtstamp, point[4])
 
-    def __addPoint(self, time, time2, date, date2, summary):
+    def __addPoint(self, start, end, dtstamp, summary):
+        """Add an event. start and end are (epoch, string) pairs as returned
+        by _icsTimes; dtstamp is a preformatted UTC timestamp."""
         ev = self.v.add('vevent')
         ev.add('summary').value = summary
         ev.add('geo').value = "%f;%f" % (self.lat, self.lon)
-        ev.add('dtstamp').value = datetime.utcnow()
-        start = ev.add('dtstart')
-        end = ev.add('dtend')
-        minute = 60 * (time - int(time))
-        second = 60 * (minute - int(minute))
-        minute2 = 60 * (time2 - int(time2))
-        second2 = 60 * (minute2 - int(minute2))
-        start.value = datetime(date.year, date.month,
-                date.day, int(time), int(minute), int(second),
-                tzinfo=self.utc)
-        end.value = datetime(date2.year, date2.month,
-                date2.day, int(time2), int(minute2), int(second2),
-                tzinfo=self.utc)
-        ev.add('uid').value = str(calendar.timegm(start.value.timetuple())) \
-                + "-1@suncalendar"
+        _addRaw(ev, 'dtstamp', dtstamp)
+        _addRaw(ev, 'dtstart', start[1])
+        _addRaw(ev, 'dtend', end[1])
+        ev.add('uid').value = str(start[0]) + "-1@suncalendar"
 
     def ical(self):
         return self.v.serialize().replace("\r\n", "\n").strip()
 
+def _icsTimes(date, times):
+    """Convert a series of (day, hours) pairs to epoch seconds and iCalendar
+    UTC date-times in one pass.
+
+    day is an offset in days from date and hours is a fractional UT time as
+    returned by the Sun class. Times are rounded to the nearest second and
+    may lie outside 0..24, in which case they roll over into the neighbouring
+    day. Returns a list of (epoch, "YYYYMMDDTHHMMSSZ") tuples."""
+    base = calendar.timegm((date.year, date.month, date.day, 0, 0, 0))
+    prefixes = {}
+    stamps = []
+    for day, hours in times:
+        carry, secs = divmod(int(round(hours * 3600)), 86400)
+        day += carry
+        epoch = base + 86400 * day
+        prefix = prefixes.get(day)
+        if prefix is None:
+            prefix = prefixes[day] = time.strftime("%Y%m%dT",
+                                                   time.gmtime(epoch))
+        hour, secs = divmod(secs, 3600)
+        minute, second = divmod(secs, 60)
+        stamps.append((epoch + 3600 * hour + 60 * minute + second,
+                       "%s%02d%02d%02dZ" % (prefix, hour, minute, second)))
+    return stamps
+
+def _addRaw(component, name, value):
+    """Add a content line whose value is already in iCalendar form, so
+    vobject serializes it as-is instead of converting a native value."""
+    line = component.add(name)
+    line.value = value
+    line.isNative = False
+    return line
+
+def _loadVobject():
+    """Import vobject into the module namespace if that hasn't happened yet."""
+    global vobject
+    if vobject is None:
+        import vobject
+    return vobject
+
 def compressBuf(buf):
+    import gzip
+    import cStringIO
     zbuf = cStringIO.StringIO()
     zfile = gzip.GzipFile(mode='wb', fileobj=zbuf)
     zfile.write(buf)
@@ -112,10 +192,158 @@ def testAcceptsGzip(req):
     else:
         return False
 
-def index(req):
-    """Serve the static index page."""
-    req.content_type = "application/xhtml+xml"
-    s = """\
+def _readFile(path):
+    f = open(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _cachedBody(key, load):
+    """Return the (plain, gzipped) body for a static response, calling load()
+    and compressing its result only the first time in each worker."""
+    try:
+        return _bodies[key]
+    except KeyError:
+        s = load()
+        _bodies[key] = (s, compressBuf(s))
+        return _bodies[key]
+
+def _send(req, s, zbuf=None, gzip=True):
+    """Write s, gzip-compressed if the client accepts it. zbuf may hold an
+    already compressed copy of s, in which case s may be None and is only
+    decompressed for clients that need it. gzip=False sends s as it is, for
+    bodies that are compressed already."""
+    if s is None and not testAcceptsGzip(req):
+        import zlib
+        s = zlib.decompress(zbuf, 16 + zlib.MAX_WBITS)
+    if gzip and testAcceptsGzip(req):
+        if zbuf is None:
+            zbuf = compressBuf(s)
+        req.headers_out['Content-Encoding'] = 'gzip'
+        req.headers_out['Content-Length'] = str(len(zbuf))
+        req.send_http_header()
+        req.write(zbuf)
+    else:
+        req.headers_out['Content-Length'] = str(len(s))
+        req.send_http_header()
+        req.write(s)
+    return apache.OK
+
+def _lruGet(cache, key, make, size):
+    """Return cache[key], calling make() to fill it in if it is missing and
+    dropping the least recently used entry once there are more than size."""
+    try:
+        value = cache.pop(key)
+    except KeyError:
+        value = make()
+        if len(cache) >= size:
+            cache.popitem(last=False)
+    cache[key] = value
+    return value
+
+def _parseHours(s):
+    """Parse "HH", "HH:MM" or decimal hours, any of them signed. None stays
+    None."""
+    if s is None or s == "":
+        return None
+    if ":" in s:
+        hours, minutes = s.split(":", 1)
+        minutes = float(minutes)
+        if not 0 <= minutes < 60:
+            raise ValueError("bad minutes %s" % s)
+        if hours.strip().startswith("-"):
+            return int(hours) - minutes / 60
+        return int(hours) + minutes / 60
+    return float(s)
+
+def _finite(*values):
+    """Raise ValueError if any of values is infinite or NaN. Nones are
+    allowed."""
+    for value in values:
+        if value is not None and (math.isinf(value) or math.isnan(value)):
+            raise ValueError("not a number %r" % value)
+
+class _Busy(Exception):
+    """Raised by _compute() when no computation slot came free."""
+
+def _compute(req, make, *args):
+    """Return make(*args), computed in one of the admission slots, or raise
+    _Busy if none came free."""
+    admission = _getAdmission(req)
+    slot = admission.acquire()
+    if slot is None:
+        raise _Busy
+    try:
+        return make(*args)
+    finally:
+        admission.release(slot)
+
+def _getAdmission(req):
+    """Return this worker's Admission, configured from PythonOption
+    SuncalQueueDir, SuncalSlots, SuncalQueue, SuncalWait, SuncalKeys and
+    SuncalWindow."""
+    global _admission
+    if _admission is None:
+        import tempfile
+        from Admission import Admission
+        options = req.get_options()
+        _admission = Admission(
+            options.get('SuncalQueueDir',
+                        os.path.join(tempfile.gettempdir(), "suncal")),
+            slots=int(options.get('SuncalSlots', 2)),
+            queue=int(options.get('SuncalQueue', 8)),
+            wait=float(options.get('SuncalWait', 10.0)),
+            keys=int(options.get('SuncalKeys', 20)),
+            window=float(options.get('SuncalWindow', 3600.0)))
+    return _admission
+
+def _getProfiler(req):
+    """Return this worker's Profiler, configured from PythonOption
+    SuncalProfileDir, SuncalProfileRate, SuncalProfileKey and
+    SuncalProfileKeep. The environment variables SUNCAL_PROFILE_RATE and
+    SUNCAL_PROFILE_KEY take precedence over the options."""
+    global _profiler
+    if _profiler is None:
+        import tempfile
+        from Profiler import Profiler
+        options = req.get_options()
+        _profiler = Profiler(
+            options.get('SuncalProfileDir',
+                        os.path.join(tempfile.gettempdir(), "suncal-profiles")),
+            rate=float(os.environ.get('SUNCAL_PROFILE_RATE',
+                                      options.get('SuncalProfileRate', 0.0))),
+            key=os.environ.get('SUNCAL_PROFILE_KEY',
+                               options.get('SuncalProfileKey')),
+            keep=int(options.get('SuncalProfileKeep', 50)))
+    return _profiler
+
+def _reject(req, retry, reason):
+    """Turn a request away with a 503 and a Retry-After header of retry
+    seconds."""
+    req.status = apache.HTTP_SERVICE_UNAVAILABLE
+    req.content_type = 'text/plain'
+    req.headers_out['Retry-After'] = str(retry)
+    req.write(reason)
+    return apache.OK
+
+def _preload():
+    """Do the one-off work of a worker before it serves its first request:
+    import vobject and the modules of the other routes, and read and
+    compress the static bodies. Meant to be run once per Apache child, e.g.
+    with "PythonImport index::_preload <interp>".
+    As with the other internal helpers, the leading underscore keeps the
+    publisher from exposing it as a URL."""
+    _loadVobject()
+    import Admission, Profiler, Sunindex, Suntile
+    _cachedBody('index', lambda: _INDEX_PAGE)
+    for key, path in _STATIC_FILES.items():
+        try:
+            _cachedBody(key, lambda: _readFile(path))
+        except IOError:
+            pass # The route will report it.
+
+_INDEX_PAGE = """\
 <?xml version="1.0" encoding="iso-8859-1"?>
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
   "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
@@ -228,20 +456,15 @@ from one month ago.</p>
 </body>
 </html>
 """
-    if testAcceptsGzip(req):
-        zbuf = compressBuf(s)
-        req.headers_out['Content-Encoding'] = 'gzip'
-        req.headers_out['Content-Length'] = str(len(zbuf))
-        req.send_http_header()
-        req.write(zbuf)
-    else:
-        req.headers_out['Content-Length'] = str(len(s))
-        req.send_http_header()
-        req.write(s)
-    return apache.OK
+
+def index(req):
+    """Serve the static index page."""
+    req.content_type = "application/xhtml+xml"
+    return _send(req, *_cachedBody('index', lambda: _INDEX_PAGE))
 
 
-def cal(req, lat=None, lon=None, cal=None, long=None, type=None):
+def cal(req, lat=None, lon=None, cal=None, long=None, type=None,
+        profile=None):
     """Use the Suncal class to output a calendar for one year from the current
     date."""
     if lon is None:
@@ -260,63 +483,153 @@ def cal(req, lat=None, lon=None, cal=None, long=None, type=None):
     req.headers_out['Content-Disposition'] = \
         'attachment; filename="%s_%s-%s-%s_%02f_%02f.ics"' % (
         cal, d.year, d.month, d.day, float(lat), float(lon))
-    k = Suncal(float(lat), float(lon), d - timedelta(days=30), 365, cal)
-    s = k.ical()
-    if testAcceptsGzip(req):
-        zbuf = compressBuf(s)
-        req.headers_out['Content-Encoding'] = 'gzip'
-        req.headers_out['Content-Length'] = str(len(zbuf))
-        req.send_http_header()
-        req.write(zbuf)
-    else:
-        req.headers_out['Content-Length'] = str(len(s))
-        req.send_http_header()
-        req.write(s)
-    return apache.OK
+    admission = _getAdmission(req)
+    retry = admission.limit(req.connection.remote_ip,
+                            "%f;%f" % (float(lat), float(lon)))
+    if retry:
+        return _reject(req, retry, "Too many locations, try again later")
+    args = (req, admission, float(lat), float(lon), d - timedelta(days=30),
+            cal)
+    profiler = _getProfiler(req)
+    if profiler.wanted(profile):
+        return profiler.call("cal", _calendar, *args)
+    return _calendar(*args)
+
+
+def _calendar(req, admission, lat, lon, date, cal):
+    """Build a calendar in a computation slot and send it."""
+    slot = admission.acquire()
+    if slot is None:
+        return _reject(req, admission.retryAfter(),
+                       "Busy, try again later")
+    try:
+        k = Suncal(lat, lon, date, 365, cal)
+        s = k.ical()
+    finally:
+        admission.release(slot)
+    return _send(req, s)
+
+
+def query(req, lat=None, lon=None, cal="sunRiseSet", event="set",
+          after=None, before=None, start=None, days="730"):
+    """List the runs of days, one "first last" pair per line, on which the
+    UT time of event ("rise" or "set") of the cal calendar is at or after
+    after and before before, for days days from start (YYYY-MM-DD, default
+    today)."""
+    from Sunindex import Sunindex
+    req.content_type = 'text/plain'
+    try:
+        lat = float(lat)
+        lon = float(lon)
+        after = _parseHours(after)
+        before = _parseHours(before)
+        days = int(days)
+        if start:
+            d = datetime.strptime(start, "%Y-%m-%d").date()
+        else:
+            d = datetime.today().date()
+        _finite(lat, lon, after, before)
+        if abs(lat) > 90 or not 0 < days <= _QUERY_MAX_DAYS:
+            raise ValueError
+        Sunindex.check(cal, event)
+    except (TypeError, ValueError):
+        req.status = apache.HTTP_BAD_REQUEST
+        req.write("Bad query")
+        return apache.OK
+    try:
+        k = _lruGet(_indexes, (lat, lon, cal, d, days),
+                    lambda: _compute(req, Sunindex, lat, lon, d, days, cal),
+                    _INDEX_CACHE_SIZE)
+    except _Busy:
+        return _reject(req, _getAdmission(req).retryAfter(),
+                       "Busy, try again later")
+    return _send(req, "".join(["%s %s\n" % (first, last) for first, last
+                               in k.query(event, after, before)]))
+
+
+def tile(req, z=None, x=None, y=None, date=None, value="dayLength",
+         event="rise", format="png"):
+    """Serve a 256x256 map tile z/x/y of the Sun macro value on date
+    (YYYY-MM-DD, default today), as a greyscale PNG or, with
+    format=float32, raw little-endian floats."""
+    from Suntile import Suntile
+    try:
+        z = int(z)
+        x = int(x)
+        y = int(y)
+        if date:
+            d = datetime.strptime(date, "%Y-%m-%d").date()
+        else:
+            d = datetime.today().date()
+        if format not in ('png', 'float32'):
+            raise ValueError
+        Suntile.check(z, x, y, value, event)
+    except (TypeError, ValueError):
+        req.content_type = 'text/plain'
+        req.status = apache.HTTP_BAD_REQUEST
+        req.write("Bad tile")
+        return apache.OK
+    global _tileBytes
+    if Sun.GRID_MACROS[value][0] == 'daylen':
+        event = 'rise' # Ignored; one cache entry whatever was asked.
+    key = (z, x, y, d, value, event, format)
+    body = _tiles.pop(key, None)
+    if body is None:
+        try:
+            k = _compute(req, Suntile, z, x, y, d, value, event)
+        except _Busy:
+            return _reject(req, _getAdmission(req).retryAfter(),
+                           "Busy, try again later")
+        if format == 'png':
+            body = k.png()
+        else:
+            body = compressBuf(k.float32())
+        _tileBytes += len(body)
+        while _tiles and _tileBytes > _TILE_CACHE_BYTES:
+            _tileBytes -= len(_tiles.popitem(last=False)[1])
+    _tiles[key] = body
+    if format == 'png':
+        req.content_type = 'image/png'
+        return _send(req, body, gzip=False)
+    req.content_type = 'application/octet-stream'
+    return _send(req, None, body)
+
+
+def status(req):
+    """Report the calendar queue metrics as plain text."""
+    req.content_type = 'text/plain'
+    stats = _getAdmission(req).stats()
+    keys = stats.keys()
+    keys.sort()
+    return _send(req, "".join(["%s %s\n" % (key, stats[key])
+                               for key in keys]))
+
+
+def profiles(req, key=None):
+    """Summarize the saved cal profiles. Needs the profiling key."""
+    req.content_type = 'text/plain'
+    profiler = _getProfiler(req)
+    if not profiler.authorized(key):
+        req.status = apache.HTTP_FORBIDDEN
+        req.write("Forbidden")
+        return apache.OK
+    return _send(req, profiler.summary())
 
 
 def Sunsource(req):
     """Distribute the Sun module."""
     req.content_type = "application/x-python"
     req.headers_out['Content-Disposition'] = 'attachment; filename="Sun.py"'
-    f = open("/var/www/markc/markc.dev.obanmultilingual.com/web/suncal/Sun.py")
-    try:
-        s = f.read()
-    finally:
-        f.close()
-    if testAcceptsGzip(req):
-        zbuf = compressBuf(s)
-        req.headers_out['Content-Encoding'] = 'gzip'
-        req.headers_out['Content-Length'] = str(len(zbuf))
-        req.send_http_header()
-        req.write(zbuf)
-    else:
-        req.headers_out['Content-Length'] = str(len(s))
-        req.send_http_header()
-        req.write(s)
-    return apache.OK
+    path = _STATIC_FILES['Sunsource']
+    return _send(req, *_cachedBody('Sunsource', lambda: _readFile(path)))
 
 
 def source(req):
     """Deliver the source. Self-replicating code!"""
     req.content_type = "application/x-python"
     req.headers_out['Content-Disposition'] = 'attachment; filename="Suncalendar.py"'
-    f = open("/var/www/markc/markc.dev.obanmultilingual.com/web/suncal/index.py")
-    try:
-        s = f.read()
-    finally:
-        f.close()
-    if testAcceptsGzip(req):
-        zbuf = compressBuf(s)
-        req.headers_out['Content-Encoding'] = 'gzip'
-        req.headers_out['Content-Length'] = str(len(zbuf))
-        req.send_http_header()
-        req.write(zbuf)
-    else:
-        req.headers_out['Content-Length'] = str(len(s))
-        req.send_http_header()
-        req.write(s)
-    return apache.OK
+    path = _STATIC_FILES['source']
+    return _send(req, *_cachedBody('source', lambda: _readFile(path)))
 
 
 def Suncalendar(req):
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+# -*- coding: iso-8859-1 -*-
+
+"""Accuracy and speed regression check for the Sun algorithms. Run as
+
+    python regression.py          compare with the golden outputs
+    python regression.py record   overwrite them with the current outputs
+    python regression.py calendar check the events of generated calendars
+    python regression.py summary  check the yearly summaries against a scan
+
+The corpus is fixed: dates from 1900 to 2100, latitudes that include both
+poles and the polar circles, every altitude preset and a spread of
+longitudes. For each entry point the check reports how far the outputs have
+moved from the golden ones (in seconds of time), whether polar days and
+nights are still recognised on the same points, and how many calls a second
+it manages, so that speed and correctness are looked at together. It exits
+non-zero if anything moved by more than TOLERANCE or a polar state changed.
+
+Record the golden outputs only from a version known to be right.
+
+This file sits in the served directory, so everything callable is
+underscore-prefixed to keep the publisher from running it from a URL."""
+
+import gzip
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from Sun import Sun
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "regression-golden.txt.gz")
+
+# Largest acceptable deviation, seconds of time.
+TOLERANCE = 0.5
+
+LATITUDES = [-90.0, -89.99, -85.0, -75.0, -67.0, -66.57, -66.5, -60.0, -45.0,
+             -23.44, -10.0, -0.5, 0.0, 0.5, 15.0, 23.44, 40.0, 55.93, 63.0,
+             66.5, 66.57, 67.0, 80.0, 89.99, 90.0]
+LONGITUDES = [-180.0, -122.42, -3.18, 0.0, 37.62, 139.69, 179.99]
+FIRST = date(1900, 1, 1)
+LAST = date(2100, 12, 31)
+# Days between corpus dates; not a divisor of the year so that every season
+# comes round.
+STEP = 146
+# Latitudes used with each date, taken in turn from LATITUDES.
+PER_DATE = 6
+
+DAYLEN = ['dayLength', 'dayCivilTwilightLength', 'dayNauticalTwilightLength',
+          'dayAstronomicalTwilightLength']
+SUNRISET = ['sunRiseSet', 'aviationTime', 'civilTwilight', 'nauticalTwilight',
+            'astronomicalTwilight']
+
+
+def _corpus():
+    """The fixed list of (date, lat, lon) points."""
+    points = []
+    d = FIRST
+    i = 0
+    while d <= LAST:
+        for j in range(PER_DATE):
+            lat = LATITUDES[(i * PER_DATE + j) % len(LATITUDES)]
+            lon = LONGITUDES[(i + j) % len(LONGITUDES)]
+            points.append((d, lat, lon))
+        d += timedelta(days=STEP)
+        i += 1
+    return points
+
+
+def _solarDay(d, lon):
+    """d as used inside Sun: days since 2000 Jan 0.0 at local noon."""
+    return Sun._Sun__daysSince2000Jan0(d.year, d.month, d.day) + 0.5 - \
+        lon / 360.0
+
+
+def _entries():
+    """
+    The entry points checked, as (name, function of (date, lat, lon)
+    returning a tuple of outputs, seconds of time per output unit, kind).
+    kind is used for the polar check.
+    """
+    found = []
+    for name in DAYLEN:
+        f = getattr(Sun, name)
+        found.append((name, lambda d, lat, lon, f=f:
+                      (f(d.year, d.month, d.day, lon, lat),), 3600.0,
+                      'daylen'))
+    for name in SUNRISET:
+        f = getattr(Sun, name)
+        found.append((name, lambda d, lat, lon, f=f:
+                      f(d.year, d.month, d.day, lon, lat), 3600.0,
+                      'sunriset'))
+    # Degrees, which turn at 15 degrees an hour. Only the Sun's longitude
+    # from __sunpos; its distance has no equivalent in time.
+    found.append(('__sunpos', lambda d, lat, lon:
+                  Sun._Sun__sunpos(_solarDay(d, lon))[:1], 240.0, None))
+    found.append(('__GMST0', lambda d, lat, lon:
+                  (Sun._Sun__GMST0(_solarDay(d, lon)),), 240.0, None))
+    return found
+
+
+def _evaluate(points):
+    """Returns {name: [outputs for each point]}."""
+    outputs = {}
+    for name, f, scale, kind in _entries():
+        outputs[name] = [f(d, lat, lon) for d, lat, lon in points]
+    return outputs
+
+
+def _polarState(name, kind, values):
+    """'above', 'below' or None for an output of an entry point."""
+    if kind == 'daylen':
+        if values[0] == 24.0:
+            return 'above'
+        if values[0] == 0.0:
+            return 'below'
+    elif kind == 'sunriset':
+        arc = values[1] - values[0]
+        if name == 'aviationTime':
+            arc -= 1.0
+        if abs(arc - 24.0) < 1e-9:
+            return 'above'
+        if abs(arc) < 1e-9:
+            return 'below'
+    return None
+
+
+def _record(points):
+    outputs = _evaluate(points)
+    names = [name for name, f, scale, kind in _entries()]
+    f = gzip.open(GOLDEN, "wb")
+    try:
+        f.write(" ".join(names) + "\n")
+        for i, (d, lat, lon) in enumerate(points):
+            fields = [d.isoformat(), repr(lat), repr(lon)]
+            for name in names:
+                fields.extend([repr(v) for v in outputs[name][i]])
+            f.write(" ".join(fields) + "\n")
+    finally:
+        f.close()
+    print "Recorded %d points to %s" % (len(points), GOLDEN)
+
+
+def _load(points):
+    """Read the golden outputs in the form _evaluate() returns."""
+    f = gzip.open(GOLDEN, "rb")
+    try:
+        names = f.readline().split()
+        lines = f.read().splitlines()
+    finally:
+        f.close()
+    if len(lines) != len(points):
+        raise ValueError("golden file has %d points, corpus %d" % (
+            len(lines), len(points)))
+    widths = dict([(name, len(f(FIRST, 0.0, 0.0)))
+                   for name, f, scale, kind in _entries()])
+    golden = dict([(name, []) for name in names])
+    for line, (d, lat, lon) in zip(lines, points):
+        fields = line.split()
+        if fields[:3] != [d.isoformat(), repr(lat), repr(lon)]:
+            raise ValueError("golden file does not match the corpus at %s" %
+                             " ".join(fields[:3]))
+        values = [float(v) for v in fields[3:]]
+        for name in names:
+            golden[name].append(tuple(values[:widths[name]]))
+            values = values[widths[name]:]
+    return golden
+
+
+def _percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+
+def _throughput(f, points):
+    """Best calls per second over the corpus."""
+    best = None
+    for i in range(3):
+        started = time.time()
+        for d, lat, lon in points:
+            f(d, lat, lon)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(points) / max(best, 1e-9)
+
+
+def _check(points):
+    golden = _load(points)
+    ok = True
+    print "%-30s %10s %10s %10s %10s %6s %10s" % (
+        "entry point", "p50 s", "p99 s", "max s", "polar", "agree", "calls/s")
+    for name, f, scale, kind in _entries():
+        if name not in golden:
+            print "%-30s not in golden file" % name
+            ok = False
+            continue
+        deviations = []
+        agree = total = polar = 0
+        for expected, (d, lat, lon) in zip(golden[name], points):
+            actual = f(d, lat, lon)
+            for a, e in zip(actual, expected):
+                deviations.append(abs(a - e) * scale)
+            state = _polarState(name, kind, expected)
+            if state:
+                polar += 1
+            if kind:
+                total += 1
+                if _polarState(name, kind, actual) == state:
+                    agree += 1
+        deviations.sort()
+        print "%-30s %10.3g %10.3g %10.3g %10s %6s %10.0f" % (
+            name, _percentile(deviations, 50), _percentile(deviations, 99),
+            deviations[-1], kind and "%d/%d" % (polar, total) or "-",
+            kind and "%.1f%%" % (100.0 * agree / total) or "-",
+            _throughput(f, points))
+        if deviations[-1] > TOLERANCE or agree != total:
+            ok = False
+    print ok and "OK" or "REGRESSION"
+    return ok
+
+
+# (lat, lon) of the calendars checked by _checkCalendars. Away from the
+# polar circles, where a day or night can have no end.
+CALENDAR_PLACES = [(40.71, -74.01), (34.05, -118.24), (21.31, -157.86),
+                   (55.93, -3.18), (35.68, 139.69), (-33.87, 151.21)]
+CALENDARS = ['sunRiseSet', 'aviationTime', 'civilTwilight', 'nauticalTwilight',
+             'astronomicalTwilight', 'dayNightTime']
+
+
+def _checkCalendars():
+    """Check that no event of a year's calendar ends before it starts. Needs
+    vobject and mod_python, as index.py does."""
+    from index import Suncal
+    ok = True
+    for lat, lon in CALENDAR_PLACES:
+        for cal in CALENDARS:
+            events = bad = 0
+            for line in Suncal(lat, lon, datetime(2024, 1, 1), 366,
+                               cal).ical().split("\n"):
+                if line.startswith("DTSTART:"):
+                    start = line[8:]
+                elif line.startswith("DTEND:"):
+                    events += 1
+                    if line[6:] < start:
+                        bad += 1
+                        if bad == 1:
+                            print "%s at %s,%s: DTSTART %s DTEND %s" % (
+                                cal, lat, lon, start, line[6:])
+            if bad:
+                print "%s at %s,%s: %d of %d events end before they start" % (
+                    cal, lat, lon, bad, events)
+                ok = False
+    print ok and "OK" or "REGRESSION"
+    return ok
+
+
+SUMMARIES = [('dayLength', 'dayLengthSummary'),
+             ('dayCivilTwilightLength', 'dayCivilTwilightLengthSummary'),
+             ('dayAstronomicalTwilightLength',
+              'dayAstronomicalTwilightLengthSummary')]
+SUMMARY_YEARS = [1950, 2000, 2023, 2024, 2090]
+SUMMARY_LATITUDES = [-90.0, -89.5, -80.0, -70.0, -66.5, -66.0, -60.0, -45.0,
+                     -23.4, -10.0, -5.0, -1.0, 0.0, 0.5, 1.0, 3.0, 5.0, 8.0,
+                     12.0, 20.0, 35.0, 55.9, 63.0, 65.8, 66.6, 67.0, 72.0,
+                     85.0, 89.9, 90.0]
+SUMMARY_LONGITUDES = [-170.0, 0.0, 100.0]
+# Including values the day length only touches, or comes within a minute of.
+THRESHOLDS = (0.5, 8.0, 11.99, 12.0, 12.1, 16.0, 23.9)
+
+
+def _runs(days, test):
+    """(first date, last date) runs of the (date, hours) days passing
+    test."""
+    runs = []
+    for d, hours in days:
+        if not test(hours):
+            continue
+        if runs and runs[-1][1] == d - timedelta(days=1):
+            runs[-1] = (runs[-1][0], d)
+        else:
+            runs.append((d, d))
+    return runs
+
+
+def _scanSummary(f, year, lon, lat):
+    """What the summary macros return, worked out by calling f every day."""
+    days = []
+    d = date(year, 1, 1)
+    while d.year == year:
+        days.append((d, f(d.year, d.month, d.day, lon, lat)))
+        d += timedelta(days=1)
+    longest = shortest = days[0]
+    for day in days:
+        if day[1] > longest[1]:
+            longest = day
+        if day[1] < shortest[1]:
+            shortest = day
+    crossings = {}
+    for threshold in THRESHOLDS:
+        crossings[threshold] = [(d, hours >= threshold) for (p, previous),
+                                (d, hours) in zip(days, days[1:])
+                                if (hours >= threshold) !=
+                                (previous >= threshold)]
+    return {'longest': longest, 'shortest': shortest,
+            'polarDays': _runs(days, lambda hours: hours == 24.0),
+            'polarNights': _runs(days, lambda hours: hours == 0.0),
+            'crossings': crossings}
+
+
+def _checkSummaries():
+    """Check the summary macros against a scan of every day of the year."""
+    total = bad = 0
+    for name, summaryName in SUMMARIES:
+        f = getattr(Sun, name)
+        summarize = getattr(Sun, summaryName)
+        for year in SUMMARY_YEARS:
+            for lat in SUMMARY_LATITUDES:
+                for lon in SUMMARY_LONGITUDES:
+                    expected = _scanSummary(f, year, lon, lat)
+                    actual = summarize(year, lon, lat, THRESHOLDS)
+                    differ = [key for key in ('polarDays', 'polarNights',
+                                              'crossings')
+                              if actual[key] != expected[key]]
+                    # On polar days or nights the extreme lasts many days and
+                    # the summary picks one of them, so only its value counts.
+                    for key, plateau in (('longest', 24.0),
+                                         ('shortest', 0.0)):
+                        if actual[key][1] != expected[key][1] or \
+                                (expected[key][1] != plateau and
+                                 actual[key][0] != expected[key][0]):
+                            differ.append(key)
+                    total += 1
+                    if differ:
+                        bad += 1
+                        print "%s %d at %s,%s: %s differ" % (
+                            summaryName, year, lat, lon, ", ".join(differ))
+    print "%d of %d summaries differ from the scan" % (bad, total)
+    print bad and "REGRESSION" or "OK"
+    return not bad
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["calendar"]:
+        sys.exit(not _checkCalendars() and 1 or 0)
+    if sys.argv[1:] == ["summary"]:
+        sys.exit(not _checkSummaries() and 1 or 0)
+    points = _corpus()
+    if sys.argv[1:] == ["record"]:
+        _record(points)
+    else:
+        sys.exit(not _check(points) and 1 or 0)